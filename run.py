@@ -1,31 +1,80 @@
 import pandas as pd
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import argparse
 import sys
 import logging
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
+import hashlib
+import os
+import time
+import tempfile
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from rapidfuzz import fuzz
+from rapidfuzz import process
+from rapidfuzz import utils
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+COLUMN_MAPPINGS = {
+    'Sr. No.': ['Sr. No.', 'Sr No', 'Serial No'],
+    'Transaction Date': ['Transaction Date', 'Date'],
+    'Scheme': ['Scheme', 'Fund Name'],
+    'Units': ['Units'],
+    'Gross Amount': ['Gross Amount', 'Amount']
+}
+KNOWN_COLUMNS = {name for possible_names in COLUMN_MAPPINGS.values() for name in possible_names}
+HEADER_SEARCH_ROWS = 20
+
+# the calamine engine needs pandas >= 2.2 and the python-calamine package
+CALAMINE_AVAILABLE = (tuple(int(part) for part in pd.__version__.split('.')[:2]) >= (2, 2)
+                      and importlib.util.find_spec('python_calamine') is not None)
+
+NAV_CACHE_DIR = '.nav_cache'
+NAV_CACHE_TTL = 24 * 60 * 60 # NAVs are published at most once a day
+NAV_REQUEST_TIMEOUT = 10
+
+# shared across the concurrent NAV fetches so connections to the API are reused
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+def read_excel_table(file_path, **kwargs):
+    # calamine parses xlsx natively; otherwise let pandas pick its default engine from the file extension
+    if CALAMINE_AVAILABLE:
+        return pd.read_excel(file_path, engine='calamine', **kwargs)
+    return pd.read_excel(file_path, **kwargs)
+
+def find_header_row(preview):
+    for position, row in enumerate(preview.itertuples(index=False)):
+        values = set(row)
+        if all(any(name in values for name in possible_names) for possible_names in COLUMN_MAPPINGS.values()):
+            return position
+    raise ValueError(f"Could not find a header row in the first {HEADER_SEARCH_ROWS} rows")
+
 def read_transactions(file_path):
     try:
-        df = pd.read_excel(file_path, skiprows=4) # todo: too specific to my input file type where the data table started from the 5th row, skip_rows needs to be modified
+        # statements often start with a few lines of account details, so locate the table header first
+        df = read_excel_table(file_path, header=None)
+        header_row = find_header_row(df.head(HEADER_SEARCH_ROWS))
+        header = df.iloc[header_row]
+        # repeated labels (e.g. a second Date column) keep only their first occurrence, as the name lookup below did
+        first_positions = {}
+        for position, name in enumerate(header):
+            if name in KNOWN_COLUMNS:
+                first_positions.setdefault(name, position)
+        known_positions = sorted(first_positions.values())
         
-        logging.info(f"Columns in the file: {df.columns.tolist()}")
+        df = df.iloc[header_row + 1:, known_positions]
+        df.columns = header.iloc[known_positions].tolist()
+        df = df.infer_objects()
         
-        column_mappings = {
-            'Sr. No.': ['Sr. No.', 'Sr No', 'Serial No'],
-            'Transaction Date': ['Transaction Date', 'Date'],
-            'Scheme': ['Scheme', 'Fund Name'],
-            'Units': ['Units'],
-            'Gross Amount': ['Gross Amount', 'Amount']
-        }
+        logging.info(f"Columns in the file: {df.columns.tolist()}")
         
         actual_columns = {}
-        for expected_col, possible_names in column_mappings.items():
+        for expected_col, possible_names in COLUMN_MAPPINGS.items():
             found = False
             for name in possible_names:
                 if name in df.columns:
@@ -35,25 +84,61 @@ def read_transactions(file_path):
             if not found:
                 raise ValueError(f"Could not find a column matching '{expected_col}'")
         
-        df = df.rename(columns={v: k for k, v in actual_columns.items()})
+        rename_map = {v: k for k, v in actual_columns.items()}
+        df.columns = [rename_map.get(c, c) for c in df.columns]
         
         df['Transaction Date'] = pd.to_datetime(df['Transaction Date'], format='%d-%m-%Y', errors='coerce')
         df['Units'] = pd.to_numeric(df['Units'], errors='coerce')
         df['Gross Amount'] = pd.to_numeric(df['Gross Amount'], errors='coerce')
         
-        df = df.dropna(subset=['Transaction Date', 'Units', 'Gross Amount'])
+        valid = np.isfinite(df['Units'].to_numpy()) & np.isfinite(df['Gross Amount'].to_numpy()) & df['Transaction Date'].notna().to_numpy()
+        df = df[valid]
         
         if df.empty:
             raise ValueError("No valid data remaining after removing null values")
         
+        df = df.assign(Scheme=df['Scheme'].astype('category'))
+        
         return df
     except Exception as e:
         logging.error(f"Error reading transaction file: {e}")
         return None
 
+def nav_cache_path(api_url):
+    return os.path.join(NAV_CACHE_DIR, hashlib.sha256(api_url.encode('utf-8')).hexdigest() + '.pkl')
+
+def load_cached_nav_data(api_url):
+    cache_path = nav_cache_path(api_url)
+    try:
+        if time.time() - os.path.getmtime(cache_path) > NAV_CACHE_TTL:
+            return None
+        nav_data, scheme_name = pd.read_pickle(cache_path)
+    except Exception:
+        return None
+    logging.info(f"Loaded cached data for: {scheme_name}")
+    return nav_data, scheme_name
+
+def save_cached_nav_data(api_url, nav_data, scheme_name):
+    temp_path = None
+    try:
+        os.makedirs(NAV_CACHE_DIR, exist_ok=True)
+        # write to a temp file and swap it in, so concurrent or interrupted writes never leave a partial cache file
+        fd, temp_path = tempfile.mkstemp(dir=NAV_CACHE_DIR, suffix='.tmp')
+        os.close(fd)
+        pd.to_pickle((nav_data, scheme_name), temp_path)
+        os.replace(temp_path, nav_cache_path(api_url))
+    except OSError as e:
+        logging.warning(f"Could not cache NAV data: {e}")
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
 def fetch_nav_data(api_url):
+    cached = load_cached_nav_data(api_url)
+    if cached is not None:
+        return cached
+    
     try:
-        response = requests.get(api_url)
+        response = SESSION.get(api_url, timeout=NAV_REQUEST_TIMEOUT)
         response.raise_for_status()
         data = response.json()
         
@@ -65,54 +150,102 @@ def fetch_nav_data(api_url):
         meta_data = data['meta']
         logging.info(f"Fetched data for: {meta_data['scheme_name']}")
         
+        save_cached_nav_data(api_url, nav_data, meta_data['scheme_name'])
+        
         return nav_data, meta_data['scheme_name']
     except requests.RequestException as e:
         logging.error(f"Error fetching NAV data: {e}")
         return None, None
 
-def calculate_portfolio_value(transactions, nav_data, is_potential=False):
-    if transactions.empty or nav_data.empty:
+def to_day_numbers(dates):
+    # NAVs are daily, so int32 days since the epoch are enough and halve the search key width
+    return dates.to_numpy().astype('datetime64[D]').astype('int32')
+
+def to_nav_arrays(nav_data):
+    # (day numbers, navs) arrays of a date-sorted NAV history, built once per API and reused for every lookup
+    if not nav_data['date'].is_monotonic_increasing:
+        nav_data = nav_data.sort_values('date')
+    return to_day_numbers(nav_data['date']), nav_data['nav'].to_numpy(dtype='float64')
+
+def lookup_nav(nav_dates, transaction_dates):
+    # position of the first NAV on or after each transaction date, i.e. a forward as-of lookup
+    positions = np.searchsorted(nav_dates, transaction_dates, side='left')
+    found = positions < len(nav_dates)
+    return np.minimum(positions, len(nav_dates) - 1), found
+
+def compute_values(units, current_nav, gross_amounts):
+    # plain ndarray kernel: current value per transaction, gain over the amount invested, and the portfolio total
+    current_values = units * current_nav
+    return current_values, current_values - gross_amounts, np.nansum(current_values)
+
+def calculate_portfolio_value(transactions, nav_arrays, is_potential=False):
+    nav_dates, navs = nav_arrays
+    if transactions.empty or len(navs) == 0:
         logging.error("Empty transactions or NAV data")
         return 0, pd.DataFrame()
     
-    merged = pd.merge_asof(transactions.sort_values('Transaction Date'),
-                           nav_data.sort_values('date'),
-                           left_on='Transaction Date',
-                           right_on='date',
-                           direction='forward')
+    # callers pass date-sorted transactions; only pay for a sort when they don't
+    if not transactions['Transaction Date'].is_monotonic_increasing:
+        transactions = transactions.sort_values('Transaction Date')
     
-    if merged.empty:
-        logging.error("No matching dates found between transactions and NAV data")
-        return 0, pd.DataFrame()
+    positions, found = lookup_nav(nav_dates, to_day_numbers(transactions['Transaction Date']))
+    
+    merged = transactions.reset_index(drop=True)
+    merged['date'] = pd.Series(nav_dates[positions].astype('datetime64[D]')).where(found)
+    merged['nav'] = pd.Series(navs[positions]).where(found)
     
-    current_nav = nav_data.iloc[-1]['nav']
+    current_nav = navs[-1]
+    
+    if is_potential:
+        # units the same gross amounts would have bought at the potential fund's NAV
+        merged['Units'] = merged['Gross Amount'] / merged['nav']
+    
+    current_values, value_differences, total_value = compute_values(merged['Units'].to_numpy(dtype='float64'), current_nav, merged['Gross Amount'].to_numpy(dtype='float64'))
     
     merged['Current NAV'] = current_nav
-    merged['Current Value'] = merged['Units'] * current_nav
+    merged['Current Value'] = current_values
     
     if is_potential:
-        merged['Original Units'] = merged['Gross Amount'] / merged['nav']
+        merged['Original Units'] = merged['Units']
         merged['Units Difference'] = merged['Units'] - merged['Original Units']
-        merged['Value Difference'] = merged['Current Value'] - merged['Gross Amount']
-    
-    total_value = merged['Current Value'].sum()
+        merged['Value Difference'] = value_differences
     
     return total_value, merged
 
+def sort_tokens(name):
+    return " ".join(sorted(name.split()))
+
 def fuzzy_match_scheme(scheme_name, transactions_schemes, threshold=70):
-    best_match = process.extractOne(scheme_name, transactions_schemes, scorer=fuzz.token_sort_ratio)
-    if best_match and best_match[1] >= threshold:
-        return best_match[0]
+    # rapidfuzz does no preprocessing by default, so apply fuzzywuzzy's case/punctuation normalization once per name
+    query = utils.default_process(scheme_name)
+    normalized = {scheme: utils.default_process(scheme) for scheme in transactions_schemes}
+    
+    # exact and unambiguous substring hits are the common case and need no scoring
+    exact = [scheme for scheme, name in normalized.items() if name == query]
+    if exact:
+        return exact[0]
+    contains = [scheme for scheme, name in normalized.items() if query and name and (query in name or name in query)]
+    if len(contains) == 1:
+        return contains[0]
+    
+    # token-sort every candidate once, so the scorer is a plain ratio
+    processed = {scheme: sort_tokens(name) for scheme, name in normalized.items()}
+    best_match = process.extractOne(sort_tokens(query), processed, scorer=fuzz.ratio, processor=None, score_cutoff=threshold)
+    if best_match:
+        return best_match[2]
     return None
 
 def compare_portfolios(transactions, my_stock_api, potential_stock_api):
-    my_nav_data, my_scheme_name = fetch_nav_data(my_stock_api)
-    potential_nav_data, potential_scheme_name = fetch_nav_data(potential_stock_api)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        my_future = executor.submit(fetch_nav_data, my_stock_api)
+        potential_future = executor.submit(fetch_nav_data, potential_stock_api)
+        my_nav_data, my_scheme_name = my_future.result()
+        potential_nav_data, potential_scheme_name = potential_future.result()
     
     if my_nav_data is None or potential_nav_data is None:
         return None, None, None
     
-    unique_schemes = transactions['Scheme'].unique()
+    unique_schemes = transactions['Scheme'].cat.categories
     matched_scheme = fuzzy_match_scheme(my_scheme_name, unique_schemes)
     
     if matched_scheme is None:
@@ -122,21 +255,15 @@ def compare_portfolios(transactions, my_stock_api, potential_stock_api):
     
     logging.info(f"Matched API scheme '{my_scheme_name}' to transaction scheme '{matched_scheme}'")
     
-    input_transactions = transactions[transactions['Scheme'] == matched_scheme]
+    input_transactions = transactions.groupby('Scheme', observed=True, sort=False).get_group(matched_scheme).sort_values('Transaction Date')
     
     if input_transactions.empty:
         logging.error(f"No transactions found for the matched scheme: {matched_scheme}")
         return None, None, None
     
-    my_portfolio_value, my_detailed_calc = calculate_portfolio_value(input_transactions, my_nav_data)
+    my_portfolio_value, my_detailed_calc = calculate_portfolio_value(input_transactions, to_nav_arrays(my_nav_data))
     
-    transactions_potential = input_transactions.copy()
-    potential_navs = potential_nav_data.set_index('date')['nav']
-    transactions_potential['Units'] = transactions_potential.apply(
-        lambda row: row['Gross Amount'] / potential_navs.loc[row['Transaction Date']:].iloc[0],
-        axis=1
-    )
-    potential_portfolio_value, potential_detailed_calc = calculate_portfolio_value(transactions_potential, potential_nav_data, is_potential=True)
+    potential_portfolio_value, potential_detailed_calc = calculate_portfolio_value(input_transactions, to_nav_arrays(potential_nav_data), is_potential=True)
     
     comparison = {
         'Input Stock/MF (API)': my_scheme_name,
@@ -149,8 +276,17 @@ def compare_portfolios(transactions, my_stock_api, potential_stock_api):
     
     return comparison, my_detailed_calc, potential_detailed_calc
 
-def save_results(comparison, my_detailed_calc, potential_detailed_calc, output_file):
-    with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
+def save_results(comparison, my_detailed_calc, potential_detailed_calc, output_file, output_format='xlsx'):
+    if output_format == 'parquet':
+        base_name = os.path.splitext(output_file)[0]
+        pd.DataFrame([comparison]).to_parquet(f"{base_name}_summary.parquet", index=False)
+        my_detailed_calc.to_parquet(f"{base_name}_input.parquet", index=False)
+        potential_detailed_calc.to_parquet(f"{base_name}_potential.parquet", index=False)
+        logging.info(f"Comparison results and detailed calculations saved to {base_name}_*.parquet")
+        return
+    
+    # constant_memory is not usable here: pandas writes cells column by column
+    with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
         pd.DataFrame([comparison]).to_excel(writer, sheet_name='Summary', index=False)
         my_detailed_calc.to_excel(writer, sheet_name='Input Portfolio', index=False)
         potential_detailed_calc.to_excel(writer, sheet_name='Potential Portfolio', index=False)
@@ -162,7 +298,8 @@ def parse_arguments():
     parser.add_argument('input_file', help='Path to the input Excel file containing transaction data')
     parser.add_argument('my_stock_api', help='API URL for your current stock/MF')
     parser.add_argument('potential_stock_api', help='API URL for the potential stock/MF to compare')
-    parser.add_argument('--output', default='portfolio_comparison.xlsx', help='Path for the output Excel file (default: portfolio_comparison.xlsx)')
+    parser.add_argument('--output', default='portfolio_comparison.xlsx', help='Path for the output Excel file; with --output-format parquet, the base name for <name>_summary/_input/_potential.parquet (default: portfolio_comparison.xlsx)')
+    parser.add_argument('--output-format', choices=['xlsx', 'parquet'], default='xlsx', help='Write a single Excel workbook or one parquet file per sheet (default: xlsx)')
     return parser.parse_args()
 
 def main():
@@ -180,7 +317,7 @@ def main():
         logging.error("Failed to compare portfolios. Exiting.")
         sys.exit(1)
     
-    save_results(comparison, my_detailed_calc, potential_detailed_calc, args.output)
+    save_results(comparison, my_detailed_calc, potential_detailed_calc, args.output, args.output_format)
 
 if __name__ == "__main__":
     main()